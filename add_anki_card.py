@@ -4,6 +4,7 @@ Interactive Anki Card Creator using 'trans' (Translate Shell) - Multilingual
 """
 
 import sys
+import argparse
 import os
 import json
 import subprocess
@@ -12,15 +13,30 @@ import urllib.parse
 import re
 import time
 import base64
+import asyncio
+import functools
+import threading
+import webbrowser
+
+try:  # optional, faster JSON
+    import orjson
+    json_dumps, json_loads = orjson.dumps, orjson.loads
+except ImportError:
+    json_dumps, json_loads = json.dumps, json.loads
 
 ANKI_CONNECT_URL = 'http://localhost:8765'
 MODEL_NAME = 'FF basic vocabulary'
 TMP_DIR = "/tmp"
+B64_CHUNK = 57 * 1024  # multiple of 3, so no padding appears mid-stream
+IMAGE_TIMEOUT = (3, 12)  # (connect, read) seconds: fail fast on dead hosts
+JSON_DECODER = json.JSONDecoder()
+AUDIO_UNSAFE_RE = re.compile(r'[^a-zA-Z0-9]')
+SESSION = requests.Session()  # keep-alive across AnkiConnect calls
 
 def invoke(action, **params):
-    requestJson = json.dumps({'action': action, 'params': params, 'version': 6})
+    requestJson = json_dumps({'action': action, 'params': params, 'version': 6})
     try:
-        response = requests.post(ANKI_CONNECT_URL, data=requestJson).json()
+        response = json_loads(SESSION.post(ANKI_CONNECT_URL, data=requestJson).content)
         if len(response) != 2: return None
         if response['error']: print(f"AnkiConnect Error: {response['error']}")
         return response['result']
@@ -28,22 +44,43 @@ def invoke(action, **params):
         print(f"Connection Error: {e}")
         return None
 
+def action(name, **params): return {'action': name, 'params': params, 'version': 6}
+
 def check_anki_connection():
-    try: return requests.get(ANKI_CONNECT_URL).status_code == 200
+    try: return SESSION.get(ANKI_CONNECT_URL).status_code == 200
     except Exception: return False
 
+_word_cache: dict[str, set[str]] = {}
+
+def deck_words(deck):
+    # One bulk findNotes + notesInfo per deck; later checks are local.
+    # Returns None (and caches nothing) if either query fails.
+    if deck not in _word_cache:
+        ids = invoke('findNotes', query=f'deck:"{deck}"')
+        notes = invoke('notesInfo', notes=ids) if ids else ids
+        if notes is None:
+            print(f"Warning: Could not load the words of deck '{deck}'; checking this word directly.")
+            return None
+        _word_cache[deck] = {n['fields']['Word']['value'].lower() for n in notes if 'Word' in n['fields']}
+    return _word_cache[deck]
+
 def card_exists(deck, word):
+    words = deck_words(deck)
+    if words is not None: return word.lower() in words
     safe_word = word.replace('"', '\\"')
-    query = f'deck:"{deck}" "Word:{safe_word}"'
-    res = invoke('findNotes', query=query)
-    return bool(res)
+    return bool(invoke('findNotes', query=f'deck:"{deck}" "Word:{safe_word}"'))
+
+_deck_names = None
 
-def get_deck_names(): return invoke('deckNames')
+def get_deck_names():
+    # Nothing here creates decks, so one successful fetch lasts the session; failures are retried
+    global _deck_names
+    if _deck_names is None: _deck_names = invoke('deckNames')
+    return _deck_names
 
 def select_deck():
-    decks = get_deck_names()
+    decks = sorted(get_deck_names() or [], reverse=True)
     if not decks: return "Default"
-    decks.sort(reverse=True)
     print("\nAvailable Decks:")
     for i, deck in enumerate(decks, 1): print(f"{i}. {deck}")
     while True:
@@ -52,25 +89,74 @@ def select_deck():
         if choice.isdigit() and 0 < int(choice) <= len(decks): return decks[int(choice)-1]
         print("Invalid selection.")
 
-def run_trans_dump(word, lang='en'):
+async def run_trans_dump(word, lang='en'):
     # Use the target language for host language (-hl) to get definitions in that language
-    # This ensures "full immersion" definitions.
-    cmd = ["trans", "-dump", "-no-ansi", "-s", lang, "-t", lang, "-hl", lang, word]
+    # This ensures "full immersion" definitions. English keeps trans' default host language.
+    cmd = ["trans", "-dump", "-no-ansi", "-s", lang, "-t", lang, *(["-hl", lang] if lang != 'en' else []), word]
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        output = result.stdout.strip()
-        start, end = output.find('['), output.rfind(']')
-        if start != -1 and end != -1: return json.loads(output[start:end+1])
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        stdout, _ = await proc.communicate()
+        # Parse from the first '[' and stop where the JSON ends, ignoring any trailing text
+        output = stdout.decode()
+        start = output.find('[')
+        if start != -1: return JSON_DECODER.raw_decode(output, start)[0]
     except Exception: pass
     return None
 
-def download_audio(word, lang='en'):
-    filename = f"anki_audio_{re.sub(r'[^a-zA-Z0-9]', '_', word)}.mp3"
+async def download_audio(word, lang='en'):
+    filename = f"anki_audio_{AUDIO_UNSAFE_RE.sub('_', word)}.mp3"
     filepath = os.path.join(TMP_DIR, filename)
     # -speak downloads the original text audio
-    subprocess.run(["trans", "-download-audio-as", filepath, "-s", lang, "-speak", "-no-ansi", word], 
-                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    return (filepath, filename) if os.path.exists(filepath) and os.path.getsize(filepath) > 0 else (None, None)
+    proc = await asyncio.create_subprocess_exec("trans", "-download-audio-as", filepath, "-s", lang, "-speak", "-no-ansi", word,
+                                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    await proc.wait()
+    try: ok = os.stat(filepath).st_size > 0
+    except FileNotFoundError: ok = False
+    return (filepath, filename) if ok else (None, None)
+
+_parse_cache: dict[tuple[str, str], dict] = {}
+
+async def fetch_word(word, lang='en'):
+    # Parsed dumps are reused for the session; the audio file is deleted after each card
+    key = (word, lang)
+    if key in _parse_cache: return _parse_cache[key], await download_audio(word, lang)
+    # The dump and the audio download are independent 'trans' runs; overlap them
+    dump, audio = await asyncio.gather(run_trans_dump(word, lang), download_audio(word, lang))
+    data = parse_trans_data(dump, word)
+    if dump: _parse_cache[key] = data
+    return data, audio
+
+def download_image(img_src):
+    print(f"Downloading: {img_src}")
+    try:
+        # Not SESSION: downloads run on worker threads, and a Session isn't documented as thread-safe
+        r = requests.get(img_src, timeout=IMAGE_TIMEOUT)
+        if r.status_code == 200: return r.content
+        print(f"Failed to download {img_src}: {r.status_code}")
+    except Exception as e:
+        print(f"Download error {img_src}: {e}")
+    return None
+
+def sniff_image_ext(head, default=".jpg"):
+    # Trust the file signature over Content-Type headers and URL suffixes
+    if head[:4] == b'\x89PNG': return ".png"
+    if head[:4] == b'GIF8': return ".gif"
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP': return ".webp"
+    if head[:2] == b'\xff\xd8': return ".jpg"
+    return default
+
+async def download_images(urls):
+    return await asyncio.gather(*(asyncio.to_thread(download_image, u) for u in urls))
+
+def b64_file(path, chunk=B64_CHUNK):
+    # Returns the base64 text and the file's first 12 bytes (for sniff_image_ext)
+    out = bytearray()
+    with open(path, 'rb', buffering=chunk) as f:
+        head = b = f.read(chunk)
+        while b:
+            out += base64.b64encode(b)
+            b = f.read(chunk)
+    return out.decode('ascii'), head[:12]
 
 def parse_trans_data(data, word):
     result = {"word": word, "translation": "", "ipa": "", "pos": "", "definitions": [], "examples": []}
@@ -82,45 +168,44 @@ def parse_trans_data(data, word):
             if len(data[0]) > 1 and isinstance(data[0][1], list) and len(data[0][1]) > 3:
                 result["ipa"] = f"/{data[0][1][3]}/"
 
-        # 2. Extract Definitions and Examples
-        all_pos = set()
-        
+        # 2. Extract Definitions and Examples in one pass over data.
         # Priority 1: Explanation-style definitions
+        # Priority 2: Fallback to synonyms, kept aside and used only if no definitions found
+        all_pos = set()
+        fallback = []
         for item in data:
-            if isinstance(item, list) and len(item) > 0 and isinstance(item[0], list) and len(item[0]) > 0:
-                for pos_block in item:
-                    if isinstance(pos_block, list) and len(pos_block) > 1 and isinstance(pos_block[0], str):
-                        pos = pos_block[0]
-                        entries = pos_block[1]
-                        if not isinstance(entries, list): continue
-
-                        # Collect synonyms for this POS (entries where val is a list)
-                        synonyms = []
-                        for entry in entries:
-                            if isinstance(entry, list) and len(entry) > 0 and isinstance(entry[0], list):
-                                synonyms.extend(entry[0][:3])
-                        syn_suffix = f" | Synonyms: {', '.join(synonyms[:3])}" if synonyms else ""
-
-                        for entry in entries:
-                            if not isinstance(entry, list) or len(entry) == 0: continue
-                            val = entry[0]
-
-                            # Definitions are strings; synonym lists are lists
-                            if isinstance(val, str):
-                                all_pos.add(pos)
-                                result["definitions"].append(f"({pos}) {val}{syn_suffix}")
-                                if len(entry) > 2 and isinstance(entry[2], str):
-                                    result["examples"].append(entry[2])
-
-        # Priority 2: Fallback to synonyms if no definitions found
-        if not result["definitions"]:
-            for item in data:
-                if isinstance(item, list) and len(item) > 1 and isinstance(item[0], str):
-                    pos = item[0]
+            if type(item) is not list or not item: continue
+            head = item[0]
+            if type(head) is str:
+                if len(item) > 1: fallback.append((head, item[1]))
+                continue
+            if type(head) is not list or not head: continue
+
+            for pos_block in item:
+                if type(pos_block) is not list or len(pos_block) < 2 or type(pos_block[0]) is not str: continue
+                pos, entries = pos_block[0], pos_block[1]
+                if type(entries) is not list: continue
+
+                # Definitions are strings; synonym lists are lists
+                synonyms, defs = [], []
+                for entry in entries:
+                    if type(entry) is not list or not entry: continue
+                    val = entry[0]
+                    if type(val) is list: synonyms.extend(val[:3])
+                    elif type(val) is str: defs.append(entry)
+                syn_suffix = f" | Synonyms: {', '.join(synonyms[:3])}" if synonyms else ""
+
+                for entry in defs:
                     all_pos.add(pos)
-                    synonyms = item[1]
-                    if isinstance(synonyms, list):
-                        result["definitions"].append(f"({pos}) {', '.join(synonyms[:5])}")
+                    result["definitions"].append(f"({pos}) {entry[0]}{syn_suffix}")
+                    if len(entry) > 2 and type(entry[2]) is str:
+                        result["examples"].append(entry[2])
+
+        if not result["definitions"]:
+            for pos, synonyms in fallback:
+                all_pos.add(pos)
+                if type(synonyms) is list:
+                    result["definitions"].append(f"({pos}) {', '.join(synonyms[:5])}")
 
         result["pos"] = ", ".join(all_pos)
         if result["definitions"]:
@@ -131,13 +216,32 @@ def parse_trans_data(data, word):
 
     return result
 
+CONSOLE_BROWSERS = {'lynx', 'w3m', 'links', 'elinks', 'www-browser'}
+
+@functools.lru_cache(maxsize=1)
+def get_browser():
+    # Console browsers would fight input() for the terminal; skip only those
+    try: browser = webbrowser.get()
+    except webbrowser.Error: return None
+    if isinstance(browser, webbrowser.UnixBrowser) and not browser.background: return None
+    if os.path.basename(browser.name) in CONSOLE_BROWSERS: return None
+    return browser
+
+def open_tabs(browser, urls):
+    if not all([browser.open_new_tab(url) for url in urls]):
+        print("\nNote: Some reference pages could not be opened in the browser.")
+
 def main():
+    parser = argparse.ArgumentParser(description="Interactive Anki card creator using 'trans'")
+    parser.add_argument('--lang', help="target language code (e.g. en, fr, tr); prompted for if omitted")
+    args = parser.parse_args()
+
     if not check_anki_connection():
         subprocess.run(["dunstify", "-u", "critical", "Anki is not running!"])
         print("Error: Anki is not running.")
         sys.exit(1)
     
-    lang_code = input("Target Language Code (e.g. en, fr, tr) [en]: ").strip().lower() or 'en'
+    lang_code = (args.lang or input("Target Language Code (e.g. en, fr, tr) [en]: ")).strip().lower() or 'en'
     
     deck_name = select_deck()
     print(f"Using deck: {deck_name} | Language: {lang_code}")
@@ -153,20 +257,22 @@ def main():
                 if input("Add anyway? (y/N): ").strip().lower() != 'y':
                     continue
 
-            print(f"Fetching {lang_code} data...")
-            data = parse_trans_data(run_trans_dump(word, lang_code), word)
-            audio_path, audio_fn = download_audio(word, lang_code)
-            
+            # Nothing is fetched or opened until the duplicate check has passed.
+            # The browser starts first so its pages load while 'trans' runs.
             target_wiktionary_url = f"https://{lang_code}.wiktionary.org/wiki/{urllib.parse.quote(word)}"
             en_wiktionary_url = f"https://en.wiktionary.org/wiki/{urllib.parse.quote(word)}"
             
             langeek_url = f"https://www.google.com/search?q=site:dictionary.langeek.co+{urllib.parse.quote(word)}"
-            subprocess.Popen(["firefox",
+            browser = get_browser()
+            if not browser: print("No GUI web browser found; not opening reference pages.")
+            else: threading.Thread(target=open_tabs, daemon=True, args=(browser, [
                 f"https://www.google.com/search?tbm=isch&q={urllib.parse.quote(word)}",
                 target_wiktionary_url,
                 en_wiktionary_url,
-                langeek_url],
-                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                langeek_url],)).start()
+
+            print(f"Fetching {lang_code} data...")
+            data, (audio_path, audio_fn) = asyncio.run(fetch_word(word, lang_code))
             
             print("\n--- Card Details ---")
             print(f"IPA: {data['ipa']}")
@@ -190,7 +296,7 @@ def main():
             note = {
                 "deckName": deck_name, "modelName": MODEL_NAME,
                 "fields": {
-                    "Note ID": str(int(time.time() * 1000)),
+                    "Note ID": str(time.time_ns() // 1_000_000),
                     "Word": word, "Translation": translation, "IPA transcription": ipa,
                     "PoS": pos, "Example sentence(s)": ex_str, "Notes": notes,
                     "Article": "", "Gender": "", "Specification term": "", "Article pronunciation": "", "Order": "", "Test spelling?": ""
@@ -199,70 +305,77 @@ def main():
                 "tags": ["script_added"]
             }
             
+            # Media stores and addNote all go to AnkiConnect in one 'multi' request
+            actions = []
+            img_fnames = []
             if audio_path:
-                with open(audio_path, 'rb') as f:
-                    b64 = base64.b64encode(f.read()).decode('utf-8')
-                    invoke('storeMediaFile', filename=audio_fn, data=b64)
-                    note["fields"]["Pronunciation sound"] = f"[sound:{audio_fn}]"
+                actions.append(action('storeMediaFile', filename=audio_fn, data=b64_file(audio_path)[0]))
+                note["fields"]["Pronunciation sound"] = f"[sound:{audio_fn}]"
             
             if pic_input:
-                img_html_list = []
-                for idx, img_src in enumerate(pic_input.split(',')):
-                    img_src = img_src.strip().strip("'").strip('"')
+                # Expand user path (e.g. ~)
+                img_srcs = [os.path.expanduser(src.strip().strip("'").strip('"')) for src in pic_input.split(',')]
+                # Fetch all remote pictures at once
+                urls = [src for src in img_srcs if src.startswith("http")]
+                downloads = dict(zip(urls, asyncio.run(download_images(urls))))
+
+                for idx, img_src in enumerate(img_srcs):
                     if not img_src: continue
-                    
-                    # Expand user path (e.g. ~)
-                    img_src = os.path.expanduser(img_src)
 
                     try:
                         img_data = None
+                        b64 = None
                         ext = ".jpg"
                         
                         if img_src.startswith("http"):
-                            print(f"Downloading: {img_src}")
-                            try:
-                                r = requests.get(img_src, timeout=15)
-                                if r.status_code == 200:
-                                    img_data = r.content
-                                    ct = r.headers.get("Content-Type", "").lower()
-                                    if "png" in ct: ext = ".png"
-                                    elif "gif" in ct: ext = ".gif"
-                                    elif "webp" in ct: ext = ".webp"
-                                    elif img_src.lower().endswith(".png"): ext = ".png"
-                                    elif img_src.lower().endswith(".gif"): ext = ".gif"
-                                    elif img_src.lower().endswith(".webp"): ext = ".webp"
-                                else:
-                                    print(f"Failed to download {img_src}: {r.status_code}")
-                            except Exception as e:
-                                print(f"Download error {img_src}: {e}")
+                            img_data = downloads[img_src]
+                            if img_data: ext = sniff_image_ext(img_data[:12])
                         
                         elif os.path.exists(img_src):
                             try:
-                                with open(img_src, 'rb') as f:
-                                    img_data = f.read()
-                                ext = os.path.splitext(img_src)[1] or ".jpg"
+                                b64, head = b64_file(img_src)
+                                ext = sniff_image_ext(head, default=os.path.splitext(img_src)[1] or ".jpg")
                             except Exception as e:
                                 print(f"File read error {img_src}: {e}")
                         else:
                             print(f"Warning: Image not found: {img_src}")
 
-                        if img_data:
+                        if img_data: b64 = base64.b64encode(img_data).decode('ascii')
+
+                        if b64:
                             # Use unique filename to avoid collisions
-                            fname = f"anki_img_{int(time.time())}_{idx}{ext}"
-                            b64 = base64.b64encode(img_data).decode('utf-8')
-                            if invoke('storeMediaFile', filename=fname, data=b64):
-                                img_html_list.append(f'<img src="{fname}">')
-                            else:
-                                print(f"Failed to store media: {fname}")
+                            fname = f"anki_img_{time.time_ns()}_{idx}{ext}"
+                            actions.append(action('storeMediaFile', filename=fname, data=b64))
+                            img_fnames.append(fname)
 
                     except Exception as e:
                         print(f"Error processing {img_src}: {e}")
                 
-                if img_html_list:
-                    note["fields"]["Picture"] = " ".join(img_html_list)
+                if img_fnames:
+                    note["fields"]["Picture"] = " ".join(f'<img src="{f}">' for f in img_fnames)
 
-            res = invoke('addNote', note=note)
-            print(f"Card added! ID: {res}" if res else "Failed to add card.")
+            actions.append(action('addNote', note=note))
+            replies = invoke('multi', actions=actions)
+            if replies is None:
+                print("Failed to add card: the AnkiConnect request failed.")
+                res = None
+            else:
+                failed = set()
+                for act, reply in zip(actions[:-1], replies):
+                    if reply['error'] or not reply['result']:
+                        failed.add(act['params']['filename'])
+                        print(f"Failed to store media: {act['params']['filename']}")
+                if replies[-1]['error']: print(f"AnkiConnect Error: {replies[-1]['error']}")
+                res = replies[-1]['result']
+                print(f"Card added! ID: {res}" if res else "Failed to add card.")
+                if res and failed:
+                    # The note went out in the same batch; drop references to media that was not stored
+                    fields = {}
+                    if audio_fn in failed: fields["Pronunciation sound"] = ""
+                    if failed & set(img_fnames):
+                        fields["Picture"] = " ".join(f'<img src="{f}">' for f in img_fnames if f not in failed)
+                    invoke('updateNoteFields', note={"id": res, "fields": fields})
+            if res and deck_name in _word_cache: _word_cache[deck_name].add(word.lower())
             if audio_path and os.path.exists(audio_path): os.remove(audio_path)
 
         except KeyboardInterrupt: break